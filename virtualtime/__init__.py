@@ -4,8 +4,8 @@
 
 import sys
 import threading
-import types
 import time
+import calendar
 import datetime as datetime_module
 import weakref
 if hasattr(weakref, 'WeakSet'):
@@ -17,6 +17,7 @@ else:
             self[item] = True
 
 import logging
+import contextlib
 
 try:
     # pylint: disable-msg=C6204
@@ -48,8 +49,13 @@ _original_gmtime = time.gmtime
 _original_localtime = time.localtime
 _underlying_strftime = time.strftime
 _original_sleep = time.sleep
+if hasattr(time, 'monotonic'):
+    _original_monotonic = time.monotonic
+else:
+    # python2 doesn't have a monotonic clock, so sleeps fall back to measuring against the wall clock
+    _original_monotonic = time.time
 
-_virtual_time_state = threading.Condition()
+_virtual_time_state = threading.Condition(threading.Lock())
 # private variable that tracks whether virtual time is enabled - only to be used internally and locked with _virtual_time_state
 __virtual_time_enabled = False
 # In PyPy (as of 1.6) on all platforms, and CPython (as of 2.7.1) on Windows, datetime.datetime.[utc]now calls time.time()
@@ -58,7 +64,23 @@ _virtual_time_notify_events = WeakSet()
 _virtual_time_callback_events = WeakSet()
 _fast_forward_delay_events = WeakSet()
 _in_skip_time_change = False
+# number of threads in _virtual_sleep waiting on _virtual_time_state, so offset changes can skip notify_all when there are none
+_waiter_count = 0
 _time_offset = 0
+# single-slot mirror of _time_offset, so the hot path can read the offset once without a global rebinding
+# it is only written under _virtual_time_state; readers take the item without locking, which stays safe on
+# free-threaded CPython as list item reads and stores are atomic there too
+_offset_box = [0]
+# _time_offset as a timedelta, rebuilt whenever the offset changes so datetime.now() doesn't have to
+_time_offset_td = datetime_module.timedelta(0)
+# whether a non-zero offset is in effect - written under _virtual_time_state, read without locking on the hot path
+_virtual_active = False
+# per-thread offsets pinned by snapshot(), read by virtual_time_fast()
+class _SnapshotState(threading.local):
+    """Thread-local snapshot state; offset defaults to None at class level, so reading it when unset is a plain attribute lookup"""
+    offset = None
+
+_snapshot_state = _SnapshotState()
 
 def _repair_year(s1, s2, y1, y2, year):
     """takes two strings differing only by year, and replaces their years (which must be 4-digit) with a new one"""
@@ -172,58 +194,102 @@ def in_skip_time_change():
     finally:
         _virtual_time_state.release()
 
-def _virtual_time():
-    """Overlayed form of time.time() that adds _time_offset"""
-    return _original_time() + _time_offset
-
-def _virtual_asctime(when_tuple=None):
-    """Overlayed form of time.asctime() that adds _time_offset"""
-    return _original_asctime(_virtual_localtime() if when_tuple is None else when_tuple)
-
-def _virtual_ctime(when=None):
-    """Overlayed form of time.ctime() that adds _time_offset"""
-    return _original_ctime(_virtual_time() if when is None else when)
-
-def _virtual_gmtime(when=None):
-    """Overlayed form of time.gmtime() that adds _time_offset"""
-    return _original_gmtime(_virtual_time() if when is None else when)
-
-def _virtual_localtime(when=None):
-    """Overlayed form of time.localtime() that adds _time_offset"""
-    return _original_localtime(_virtual_time() if when is None else when)
-
-def _virtual_strftime(format, when_tuple=None):
-    """Overlayed form of time.strftime() that adds _time_offset"""
-    return _original_strftime(format, _virtual_localtime() if when_tuple is None else when_tuple)
+def _make_overlayed_time_functions(_original_time, _original_asctime, _original_ctime, _original_gmtime, _original_localtime, _original_strftime, _offset_box):
+    """Builds the overlayed time functions as closures over the functions they call, so the lookups are local rather than global"""
+    def _virtual_time():
+        """Overlayed form of time.time() that adds _time_offset"""
+        offset = _offset_box[0]
+        if not offset:
+            return _original_time()
+        return _original_time() + offset
+
+    def _virtual_asctime(when_tuple=None):
+        """Overlayed form of time.asctime() that adds _time_offset"""
+        if when_tuple is None and not _virtual_active:
+            return _original_asctime()
+        return _original_asctime(_virtual_localtime() if when_tuple is None else when_tuple)
+
+    def _virtual_ctime(when=None):
+        """Overlayed form of time.ctime() that adds _time_offset"""
+        if when is None and not _virtual_active:
+            return _original_ctime()
+        return _original_ctime(_virtual_time() if when is None else when)
+
+    def _virtual_gmtime(when=None):
+        """Overlayed form of time.gmtime() that adds _time_offset"""
+        if when is None and not _virtual_active:
+            return _original_gmtime()
+        return _original_gmtime(_virtual_time() if when is None else when)
+
+    def _virtual_localtime(when=None):
+        """Overlayed form of time.localtime() that adds _time_offset"""
+        if when is None and not _virtual_active:
+            return _original_localtime()
+        return _original_localtime(_virtual_time() if when is None else when)
+
+    def _virtual_strftime(format, when_tuple=None):
+        """Overlayed form of time.strftime() that adds _time_offset"""
+        if when_tuple is None and not _virtual_active:
+            return _original_strftime(format)
+        return _original_strftime(format, _virtual_localtime() if when_tuple is None else when_tuple)
+
+    return _virtual_time, _virtual_asctime, _virtual_ctime, _virtual_gmtime, _virtual_localtime, _virtual_strftime
+
+_virtual_time, _virtual_asctime, _virtual_ctime, _virtual_gmtime, _virtual_localtime, _virtual_strftime = _make_overlayed_time_functions(
+    _original_time, _original_asctime, _original_ctime, _original_gmtime, _original_localtime, _original_strftime, _offset_box)
+
+@contextlib.contextmanager
+def snapshot():
+    """Pins the current offset for this thread, so virtual_time_fast() ignores offset changes until the block exits"""
+    previous = _snapshot_state.offset
+    _snapshot_state.offset = _offset_box[0]
+    try:
+        yield
+    finally:
+        _snapshot_state.offset = previous
+
+def _make_virtual_time_fast(_original_time, _offset_box, _snapshot_state):
+    """Builds virtual_time_fast as a closure over the state it reads, so the lookups are local rather than global"""
+    def virtual_time_fast():
+        """Form of time.time() that uses this thread's snapshot() offset if there is one, else _time_offset"""
+        offset = _snapshot_state.offset
+        if offset is None:
+            offset = _offset_box[0]
+        if not offset:
+            return _original_time()
+        return _original_time() + offset
+    return virtual_time_fast
+
+virtual_time_fast = _make_virtual_time_fast(_original_time, _offset_box, _snapshot_state)
 
 def _virtual_sleep(seconds):
     """Overlayed form of time.sleep() that responds to changes to the virtual time"""
-    expected_end = _virtual_time() + seconds
-    while True:
-        remaining = expected_end - _virtual_time()
-        if remaining <= 0:
-            break
-        # At least limit the fallout to a reasonably busy wait to get the lock
-        if _virtual_time_state.acquire(False):
+    global _waiter_count
+    with _virtual_time_state:
+        # measured on the monotonic clock plus the offset, so that only offset changes (not wall clock jumps) shorten the sleep
+        expected_end = _original_monotonic() + _offset_box[0] + seconds
+        while True:
+            remaining = expected_end - (_original_monotonic() + _offset_box[0])
+            if remaining <= 0:
+                break
+            # changes to the offset notify all waiters, so the remaining time gets recalculated on each wakeup
+            _waiter_count += 1
             try:
-                remaining = expected_end - _virtual_time()
                 _virtual_time_state.wait(remaining)
             finally:
-                _virtual_time_state.release()
-        else:
-            _original_sleep(0.001)
+                _waiter_count -= 1
 
 _original_datetime_module = datetime_module
 _underlying_datetime_type = _original_datetime_module.datetime
 
-_virtual_datetime_attrs = dict(_underlying_datetime_type.__dict__.items())
 class datetime(_original_datetime_module.datetime):
     def __new__(cls, *args, **kwargs):
-        if args and isinstance(args[0], _underlying_datetime_type):
-            dt = args[0]
-        else:
-            dt = _underlying_datetime_type.__new__(cls, *args, **kwargs)
-        newargs = list(dt.timetuple()[0:6])+[dt.microsecond, dt.tzinfo]
+        if not (args and isinstance(args[0], _underlying_datetime_type)):
+            return _underlying_datetime_type.__new__(cls, *args, **kwargs)
+        dt = args[0]
+        if type(dt) is cls:
+            return dt
+        newargs = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
         return _underlying_datetime_type.__new__(cls, *newargs)
 
     def _fixed_strftime(self, format_str):
@@ -261,8 +327,8 @@ class datetime(_original_datetime_module.datetime):
             # make the original datetime.now method counteract the offsets in time.time()
             dt = _underlying_datetime_type.now(tz=tz)
             if time.time != _original_time:
-                dt = dt + _original_datetime_module.timedelta(seconds=-_time_offset)
-            newargs = list(dt.timetuple()[0:6])+[dt.microsecond, dt.tzinfo]
+                dt = dt - _time_offset_td
+            newargs = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
             return _original_datetime_type.__new__(cls, *newargs)
 
         @classmethod
@@ -271,8 +337,8 @@ class datetime(_original_datetime_module.datetime):
             # make the original datetime.utcnow method counteract the offsets in time.time()
             dt = _underlying_datetime_type.utcnow()
             if time.time != _original_time:
-                dt = dt + _original_datetime_module.timedelta(seconds=-_time_offset)
-            newargs = list(dt.timetuple()[0:6])+[dt.microsecond, dt.tzinfo]
+                dt = dt - _time_offset_td
+            newargs = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
             return _original_datetime_type.__new__(cls, *newargs)
 
     @classmethod
@@ -335,20 +401,37 @@ class virtual_datetime(datetime):
     @classmethod
     def now(cls, tz=None):
         """Virtualized datetime.datetime.now()"""
-        dt = _original_datetime_now(tz=tz) + _original_datetime_module.timedelta(seconds=_time_offset)
-        newargs = list(dt.timetuple()[0:6])+[dt.microsecond, dt.tzinfo]
-        return _original_datetime_type.__new__(cls, *newargs)
+        # bound to cls, so the original method constructs cls directly and the offset addition preserves it
+        dt = _original_datetime_now_method.__get__(None, cls)(tz=tz)
+        if _virtual_active:
+            dt = dt + _time_offset_td
+        if type(dt) is cls:
+            return dt
+        return _underlying_datetime_type.__new__(cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
 
     @classmethod
     def utcnow(cls):
         """Virtualized datetime.datetime.utcnow()"""
-        dt = _original_datetime_utcnow() + _original_datetime_module.timedelta(seconds=_time_offset)
-        newargs = list(dt.timetuple()[0:6])+[dt.microsecond, dt.tzinfo]
-        return _original_datetime_type.__new__(cls, *newargs)
+        # bound to cls, so the original method constructs cls directly and the offset addition preserves it
+        dt = _original_datetime_utcnow_method.__get__(None, cls)()
+        if _virtual_active:
+            dt = dt + _time_offset_td
+        if type(dt) is cls:
+            return dt
+        return _underlying_datetime_type.__new__(cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
+
+def _unbound_classmethod(klass, name):
+    """returns the descriptor for the given classmethod as defined on klass or its nearest base, so it can be bound to a subclass"""
+    for base in klass.__mro__:
+        if name in base.__dict__:
+            return base.__dict__[name]
+    raise AttributeError(name)
 
 _original_datetime_type = datetime
 _original_datetime_now = _original_datetime_type.now
 _original_datetime_utcnow = _original_datetime_type.utcnow
+_original_datetime_now_method = _unbound_classmethod(_original_datetime_type, "now")
+_original_datetime_utcnow_method = _unbound_classmethod(_original_datetime_type, "utcnow")
 _virtual_datetime_type = virtual_datetime
 datetime_module.datetime = datetime
 _virtual_datetime_now = _virtual_datetime_type.now
@@ -359,43 +442,73 @@ def totalseconds_float(timedelta):
     """Return the total number of seconds represented by a datetime.timedelta object, including fractions of seconds"""
     return timedelta.seconds + (timedelta.days * 24 * 60 * 60) + timedelta.microseconds/1000000.0
 
-def local_datetime_to_time(dt):
-    """converts a naive datetime object to a local time float"""
-    return time.mktime(dt.timetuple()) + dt.microsecond * 0.000001
+def _mktime_local_datetime_to_time(dt):
+    """converts a datetime object to a local time float using mktime, reading its fields as local time"""
+    return (int(time.mktime(dt.timetuple())) * 1000000 + dt.microsecond) / 1e6
+
+if hasattr(_underlying_datetime_type, "timestamp"):
+    _utc_timezone = _original_datetime_module.timezone.utc
+
+    def local_datetime_to_time(dt):
+        """converts a naive datetime object to a local time float
+
+        An ambiguous local time (repeated when daylight saving time ends) is resolved by dt.fold: 0 gives the earlier
+        (daylight saving) instant and 1 the later one. mktime resolved these depending on its previous call, so it isn't used for naive values"""
+        if dt.tzinfo is not None:
+            # timezone aware values have always been converted by reading their fields as local time, which timestamp() doesn't do
+            return _mktime_local_datetime_to_time(dt)
+        return dt.timestamp()
 
-def utc_datetime_to_time(dt):
-    """converts a naive utc datetime object to a local time float"""
-    return time.mktime(dt.utctimetuple()) + dt.microsecond * 0.000001 - (time.altzone if time.daylight else time.timezone)
+    def utc_datetime_to_time(dt):
+        """converts a naive utc datetime object to a local time float"""
+        if dt.tzinfo is None:
+            dt = _underlying_datetime_type.replace(dt, tzinfo=_utc_timezone)
+        return dt.timestamp()
+else:
+    # python2 datetimes don't have timestamp(), so go through mktime and timegm
+    local_datetime_to_time = _mktime_local_datetime_to_time
+
+    def utc_datetime_to_time(dt):
+        """converts a naive utc datetime object to a local time float"""
+        return (calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond) / 1e6
+
+def _change_offset(new_offset, log_message=None, in_skip_time_change=None):
+    """Changes the offset and notifies sleepers and events, logging log_message (if given) and then waiting for callbacks"""
+    global _time_offset
+    global _time_offset_td
+    global _virtual_active
+    global _in_skip_time_change
+    with _virtual_time_state:
+        if in_skip_time_change is not None:
+            _in_skip_time_change = in_skip_time_change
+        original_offset = _time_offset
+        _time_offset = new_offset
+        _offset_box[0] = _time_offset
+        _time_offset_td = _original_datetime_module.timedelta(seconds=_time_offset)
+        _virtual_active = (_time_offset != 0)
+        callback_events = list(_virtual_time_callback_events)
+        for event in callback_events:
+            event.clear()
+        if _waiter_count:
+            _virtual_time_state.notify_all()
+        for event in _virtual_time_notify_events:
+            event.set()
+    # logged outside the lock, as logging handlers may call back into virtualtime (e.g. time.sleep)
+    if log_message:
+        logging.log(TIME_CHANGE_LOG_LEVEL, log_message, original_offset, new_offset, _original_datetime_now())
+    for event in callback_events:
+        if not event.wait(MAX_CALLBACK_TIME):
+            logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
 
 def set_offset(new_offset, suppress_log=False, is_fast_forward_change=False):
     """Sets the current time offset to the given value"""
-    global _time_offset
     global _in_skip_time_change
     try:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = not is_fast_forward_change
-            original_offset = _time_offset
-            _time_offset = new_offset
-            if not suppress_log:
-                logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset adjusted from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
-            callback_events = list(_virtual_time_callback_events)
-            for event in callback_events:
-                event.clear()
-            _virtual_time_state.notify_all()
-            for event in _virtual_time_notify_events:
-                event.set()
-        finally:
-            _virtual_time_state.release()
-        for event in callback_events:
-            if not event.wait(MAX_CALLBACK_TIME):
-                logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
+        log_message = None if suppress_log else "Virtual time offset adjusted from %r to %r at %r"
+        _change_offset(new_offset, log_message, in_skip_time_change=not is_fast_forward_change)
     finally:
-        _virtual_time_state.acquire()
-        try:
+        with _virtual_time_state:
             _in_skip_time_change = False
-        finally:
-            _virtual_time_state.release()
 
 def get_offset():
     global _time_offset
@@ -403,52 +516,11 @@ def get_offset():
 
 def set_time(new_time, is_fast_forward_change=False):
     """Sets the current time to the given time.time()-equivalent value"""
-    global _time_offset
-    global _in_skip_time_change
-    try:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = not is_fast_forward_change
-            original_offset = _time_offset
-            _time_offset = new_time - _original_time()
-            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset adjusted from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
-            callback_events = list(_virtual_time_callback_events)
-            for event in callback_events:
-                event.clear()
-            _virtual_time_state.notify_all()
-            for event in _virtual_time_notify_events:
-                event.set()
-        finally:
-            _virtual_time_state.release()
-        for event in callback_events:
-            if not event.wait(MAX_CALLBACK_TIME):
-                logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
-    finally:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = False
-        finally:
-            _virtual_time_state.release()
+    set_offset(new_time - _original_time(), is_fast_forward_change=is_fast_forward_change)
 
 def restore_time():
     """Reverts to real time operation"""
-    global _time_offset
-    _virtual_time_state.acquire()
-    try:
-        original_offset = _time_offset
-        _time_offset = 0
-        logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset restored from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
-        callback_events = list(_virtual_time_callback_events)
-        for event in callback_events:
-            event.clear()
-        _virtual_time_state.notify_all()
-        for event in _virtual_time_notify_events:
-            event.set()
-    finally:
-        _virtual_time_state.release()
-    for event in callback_events:
-        if not event.wait(MAX_CALLBACK_TIME):
-            logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
+    _change_offset(0, "Virtual time offset restored from %r to %r at %r")
 
 def set_local_datetime(dt):
     """Sets the current time using the given naive local datetime object"""
@@ -467,9 +539,9 @@ def fast_forward_time(delta=None, target=None, step_size=1.0, step_wait=0.01, lo
         original_offset = _time_offset
         if target is not None:
             delta = target - original_offset - _original_time()
-        logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time commencing fastforward from %r to %r at %r", original_offset, original_offset + delta, _original_datetime_now())
     finally:
         _virtual_time_state.release()
+    logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time commencing fastforward from %r to %r at %r", original_offset, original_offset + delta, _original_datetime_now())
     _original_sleep(step_wait)
     if delta < 0:
         step_size = -step_size
@@ -626,11 +698,11 @@ def enable():
     _virtual_time_state.acquire()
     try:
         __virtual_time_enabled = True
-        logging.info("Virtual Time enabled %d times; patching modules", __virtual_time_enabled)
         patch_time_module()
         patch_datetime_module()
     finally:
         _virtual_time_state.release()
+    logging.info("Virtual Time enabled %d times; patching modules", __virtual_time_enabled)
 
 def disable():
     """Disables virtual time (actually decrements the number of times it's been enabled, and disables if 0)"""
@@ -638,8 +710,8 @@ def disable():
     _virtual_time_state.acquire()
     try:
         __virtual_time_enabled = False
-        logging.info("Virtual Time disabled %d times; unpatching modules", __virtual_time_enabled)
         unpatch_time_module()
         unpatch_datetime_module()
     finally:
         _virtual_time_state.release()
+    logging.info("Virtual Time disabled %d times; unpatching modules", __virtual_time_enabled)
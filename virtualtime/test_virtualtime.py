@@ -7,6 +7,8 @@ import datetime
 import time
 import pytz
 import pickle
+import calendar
+import contextlib
 import os
 import subprocess
 import sys
@@ -15,6 +17,7 @@ import threading
 import logging
 import datetime
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 
 
 def outside(code_str, *import_modules):
@@ -345,6 +348,16 @@ class VirtualTimeBase(object):
         datetime.datetime(*args, **kwargs)
         datetime.datetime(**kwargs_only)
 
+    def test_datetime_init_from_datetime(self):
+        """tests that constructing a datetime from an unpatched datetime instance converts it to the patched class"""
+        raw = virtualtime.raw_datetime(2012, 7, 25, 10, 27, 3, 100, tzinfo=pytz.timezone('Africa/Johannesburg'))
+        assert not isinstance(raw, datetime.datetime)
+        converted = datetime.datetime(raw)
+        assert isinstance(converted, datetime.datetime)
+        assert converted == raw
+        assert converted.tzinfo is raw.tzinfo
+        assert datetime.datetime(converted) is converted
+
     def test_time(self):
         """tests that we can set time"""
         run_time_function_tst(time.time, virtualtime.set_time, 100, enabled=self.virtual_time_enabled)
@@ -696,6 +709,104 @@ class TestInheritance(object):
         assert isinstance(datetime_tz.datetime_tz.min, datetime_tz.datetime_tz)
         assert isinstance(datetime_tz.datetime_tz.max, datetime_tz.datetime_tz)
 
+class ReentrantLogHandler(logging.Handler):
+    """Logging handler that calls back into virtualtime while handling each record"""
+    def emit(self, record):
+        virtualtime.in_skip_time_change()
+        virtualtime._virtual_sleep(0)
+
+def run_reentrant_log_scenario():
+    """Changes the offset with a ReentrantLogHandler installed - this deadlocks if virtualtime logs while holding its lock"""
+    logging.getLogger().addHandler(ReentrantLogHandler())
+    virtualtime.set_offset(100)
+    virtualtime.fast_forward_time(delta=2, step_wait=0)
+    virtualtime.restore_time()
+    return True
+
+class TestLoggingReentrancy(object):
+    """Tests that logging handlers can call into virtualtime while the offset is being changed"""
+    def test_reentrant_handler(self):
+        """Runs in a separate process, so that a deadlock can be detected without leaving this process's lock held"""
+        command_string = 'import sys; sys.path = %r; from virtualtime import test_virtualtime; sys.exit(0 if test_virtualtime.run_reentrant_log_scenario() else 1)' % (sys.path,)
+        p = subprocess.Popen([sys.executable, "-c", command_string], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ)
+        start_time = virtualtime._original_time()
+        while p.poll() is None and virtualtime._original_time() - start_time < 10:
+            virtualtime._original_sleep(0.01)
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+            raise AssertionError("changing the offset deadlocked with a reentrant logging handler")
+        assert p.returncode == 0, p.communicate()[1]
+
+class TestSnapshot(object):
+    """Tests that snapshot() pins the offset seen by virtual_time_fast() in the current thread"""
+    @restore_time_after
+    def test_snapshot(self):
+        virtualtime.set_offset(100)
+        with virtualtime.snapshot():
+            virtualtime.set_offset(200)
+            assert 99.9 <= virtualtime.virtual_time_fast() - virtualtime._original_time() <= 100.1
+            with virtualtime.snapshot():
+                assert 199.9 <= virtualtime.virtual_time_fast() - virtualtime._original_time() <= 200.1
+            assert 99.9 <= virtualtime.virtual_time_fast() - virtualtime._original_time() <= 100.1
+        assert 199.9 <= virtualtime.virtual_time_fast() - virtualtime._original_time() <= 200.1
+
+    @restore_time_after
+    def test_snapshot_other_thread(self):
+        offsets = []
+        def measure():
+            offsets.append(virtualtime.virtual_time_fast() - virtualtime._original_time())
+        with virtualtime.snapshot():
+            virtualtime.set_offset(100)
+            measure_thread = threading.Thread(target=measure)
+            measure_thread.start()
+            measure_thread.join()
+            measure()
+        assert 99.9 <= offsets[0] <= 100.1
+        assert -0.1 <= offsets[1] <= 0.1
+
+@contextlib.contextmanager
+def local_timezone(tz_name):
+    """Sets the process's local timezone to tz_name for the duration of the block (skipping the test where that isn't possible)"""
+    if not hasattr(time, "tzset"):
+        raise SkipTest("time.tzset is not available on this platform")
+    original_tz = os.environ.get("TZ")
+    os.environ["TZ"] = tz_name
+    time.tzset()
+    try:
+        yield
+    finally:
+        if original_tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = original_tz
+        time.tzset()
+
+class TestDatetimeConversion(object):
+    """Tests converting single datetime objects to time floats"""
+    def test_local_datetime_to_time_aware(self):
+        """timezone aware values are converted by reading their fields as local time, ignoring their timezone"""
+        naive = datetime.datetime(2014, 1, 15, 12, 30, 0, 500000)
+        aware = pytz.timezone('Asia/Tokyo').localize(naive)
+        assert virtualtime.local_datetime_to_time(aware) == virtualtime.local_datetime_to_time(naive)
+
+    def test_local_datetime_to_time_ambiguous(self):
+        """an ambiguous local time when daylight saving ends resolves by fold: the daylight saving instant by default, the standard time one with fold=1"""
+        if not hasattr(datetime.datetime(2014, 11, 2), "fold"):
+            raise SkipTest("datetime.fold is not available in this version of Python")
+        with local_timezone("America/Chicago"):
+            # run after converting a winter time, which would make mktime pick the standard time instant
+            virtualtime.local_datetime_to_time(datetime.datetime(2014, 1, 15, 12))
+            assert virtualtime.local_datetime_to_time(datetime.datetime(2014, 11, 2, 1, 30)) == calendar.timegm((2014, 11, 2, 6, 30, 0))
+            assert virtualtime.local_datetime_to_time(datetime.datetime(2014, 11, 2, 1, 30, fold=1)) == calendar.timegm((2014, 11, 2, 7, 30, 0))
+            assert virtualtime.local_datetime_to_time(datetime.datetime(2014, 7, 15, 12, 0, 0, 250000)) == calendar.timegm((2014, 7, 15, 17, 0, 0)) + 0.25
+
+    def test_utc_datetime_to_time_dst_zone(self):
+        """the conversion from utc is exact, including in a local timezone with daylight saving time"""
+        with local_timezone("America/Chicago"):
+            for dt in [datetime.datetime(2014, 1, 15, 12, 0, 0, 250000), datetime.datetime(2014, 7, 15, 12)]:
+                assert virtualtime.utc_datetime_to_time(dt) == calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
 _original_datetime_module = virtualtime._original_datetime_module
 _original_datetime_type = virtualtime._original_datetime_type
 _original_datetime_now = virtualtime._original_datetime_now